@@ -1,42 +1,46 @@
 import os
 import time
-import hashlib
 import asyncio
 import io
 import logging
+import multiprocessing
+import threading
+from collections import defaultdict, deque
 from functools import wraps
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from flask import Flask, request, jsonify, send_from_directory
+from quart import Quart, request, jsonify, send_from_directory
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
-from pymongo import MongoClient
-from bson.binary import Binary
-import PyPDF2
+from pymongo import UpdateOne
+try:
+    import fitz  # PyMuPDF
+    from pdf_extraction import extract_page_range
+except ImportError:
+    fitz = None
+    import PyPDF2
 from dotenv import load_dotenv
 
-from cached_code_generation import process_paper
+from cached_code_generation import process_paper, hash_stream, ensure_cache_indexes, NOT_RESEARCH_PAPER
+from db import get_database
 
 # Load environment variables
 load_dotenv()
 
-app = Flask(__name__, static_folder='static')
+app = Quart(__name__, static_folder='static')
 
 # MongoDB configuration
-MONGO_URI = os.environ.get('MONGO_URI')
-if not MONGO_URI:
-    raise ValueError("MONGO_URI environment variable is not set")
-
-# Extract database name from MONGO_URI or use a default
-db_name = os.getenv("MONGO_DB_NAME") or "Cluster0"
-
-client = MongoClient(MONGO_URI)
-db = client[db_name]
+db = get_database("Cluster0")
 files_collection = db.files
 upload_history_collection = db.upload_history
 
 # Set max content length
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB max file size
 
+# Uploads are hashed from the spooled request body in chunks of this size
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx'}
 
@@ -44,17 +48,130 @@ ALLOWED_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx'}
 RATE_LIMIT = 5  # Max uploads per IP
 RATE_LIMIT_PERIOD = 60  # Rate limit period in seconds
 
-# Create a ThreadPoolExecutor
-executor = ThreadPoolExecutor(max_workers=4)
+# Upload history write-behind configuration
+HISTORY_FLUSH_INTERVAL = 0.5  # Seconds between flushes to MongoDB
+HISTORY_FLUSH_BATCH = 1000  # Max records per bulk write
+
+# Per-IP sliding windows used for rate-limit decisions, and accepted uploads
+# waiting to be flushed to MongoDB. Both are only touched from the event loop.
+# Like the in-flight paper map and the PDF pool, this state is per process, so
+# the app is deployed as a single hypercorn worker (see Procfile); more workers
+# would multiply the per-IP limit and duplicate LLM calls across workers.
+rate_limit_windows = {}
+pending_uploads = deque()
+history_flush_event = asyncio.Event()
+history_writer_running = False
+
+# Threads backing asyncio.to_thread (hashing, PDF text extraction) per worker
+DEFAULT_EXECUTOR_WORKERS = 8
+
+# PDF extraction configuration
+PDF_WORKERS = min(4, os.cpu_count() or 1)  # Extractor processes per app worker
+PDF_PARALLEL_MIN_PAGES = 8  # Smaller documents are extracted sequentially
+
+def create_pdf_executor():
+    # Worker processes are only spawned on first use. forkserver keeps them from
+    # inheriting the Motor, gRPC and httpx threads running in this process.
+    return ProcessPoolExecutor(
+        max_workers=PDF_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver")
+    )
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+pdf_executor = create_pdf_executor()
+pdf_executor_lock = threading.Lock()
 
-def run_async(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        return asyncio.run(func(*args, **kwargs))
-    return wrapper
+async def flush_upload_history():
+    batch = defaultdict(list)
+    while pending_uploads and len(batch) < HISTORY_FLUSH_BATCH:
+        ip, timestamp = pending_uploads.popleft()
+        batch[ip].append(timestamp)
+    if not batch:
+        return
+
+    operations = [
+        UpdateOne(
+            {'ip': ip, 'timestamps': {'$exists': True}},
+            {
+                '$push': {'timestamps': {'$each': timestamps, '$slice': -RATE_LIMIT}},
+                '$max': {'timestamp': timestamps[-1]},
+                '$currentDate': {'last_seen': True}
+            },
+            upsert=True
+        )
+        for ip, timestamps in batch.items()
+    ]
+    try:
+        await upload_history_collection.bulk_write(operations, ordered=False)
+    except Exception as e:
+        app.logger.error(f"Error flushing upload history: {str(e)}")
+
+    # Forget IPs whose window has fully expired
+    cutoff = time.time() - RATE_LIMIT_PERIOD
+    for ip in [ip for ip, window in rate_limit_windows.items() if not window or window[-1] <= cutoff]:
+        del rate_limit_windows[ip]
+
+async def upload_history_writer():
+    while history_writer_running:
+        try:
+            await asyncio.wait_for(history_flush_event.wait(), HISTORY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        history_flush_event.clear()
+        await flush_upload_history()
+
+@app.before_serving
+async def create_indexes():
+    try:
+        await upload_history_collection.create_index([('ip', 1), ('timestamp', -1)])
+        # Purge per-IP history once it has been idle for a full rate limit period
+        await upload_history_collection.create_index('last_seen', expireAfterSeconds=RATE_LIMIT_PERIOD)
+    except Exception as e:
+        app.logger.error(f"Error creating upload history indexes: {str(e)}")
+    try:
+        await files_collection.create_index('content_hash', unique=True)
+    except Exception as e:
+        app.logger.error(f"Error creating unique content_hash index: {str(e)}")
+    await ensure_cache_indexes()
+
+@app.before_serving
+async def configure_default_executor():
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DEFAULT_EXECUTOR_WORKERS))
+
+@app.before_serving
+async def start_upload_history_writer():
+    global history_writer_running
+    history_writer_running = True
+    app.upload_history_task = asyncio.create_task(upload_history_writer())
+
+@app.after_serving
+async def stop_pdf_executor():
+    await asyncio.to_thread(pdf_executor.shutdown)
+
+@app.after_serving
+async def stop_upload_history_writer():
+    global history_writer_running
+    # Let a flush already in progress finish instead of cancelling it mid-write
+    history_writer_running = False
+    history_flush_event.set()
+    await app.upload_history_task
+    while pending_uploads:
+        await flush_upload_history()
+
+async def load_rate_limit_window(ip):
+    """Seed this process's window for an IP from the persisted history."""
+    history = await upload_history_collection.find_one(
+        {'ip': ip, 'timestamps': {'$exists': True}},
+        {'timestamps': 1, '_id': 0}
+    )
+    window = deque(sorted(history['timestamps']) if history else ())
+    # Another request for the same IP may have seeded it while we awaited
+    return rate_limit_windows.setdefault(ip, window)
+
+def allowed_file(filename):
+    """Return the lowercased extension if it is allowed, otherwise None."""
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else None
+    return ext if ext in ALLOWED_EXTENSIONS else None
 
 def async_rate_limit(func):
     @wraps(func)
@@ -62,42 +179,80 @@ def async_rate_limit(func):
         ip = request.remote_addr
         current_time = time.time()
 
+        window = rate_limit_windows.get(ip)
+        if window is None:
+            window = await load_rate_limit_window(ip)
+
         # Check recent requests from this IP
-        recent_uploads = await asyncio.to_thread(
-            upload_history_collection.count_documents,
-            {
-                'ip': ip,
-                'timestamp': {'$gt': current_time - RATE_LIMIT_PERIOD}
-            }
-        )
-        if recent_uploads >= RATE_LIMIT:
+        while window and window[0] <= current_time - RATE_LIMIT_PERIOD:
+            window.popleft()
+        if len(window) >= RATE_LIMIT:
             return jsonify({'error': 'Rate limit exceeded. Please try again later.'}), 429
 
-        # Record this request
-        await asyncio.to_thread(
-            upload_history_collection.insert_one,
-            {
-                'ip': ip,
-                'timestamp': current_time
-            }
-        )
+        # Record this request; it reaches MongoDB on the next flush
+        window.append(current_time)
+        pending_uploads.append((ip, current_time))
+        if len(pending_uploads) >= HISTORY_FLUSH_BATCH:
+            history_flush_event.set()
 
         return await func(*args, **kwargs)
     return wrapper
 
+def extract_ranges_in_pool(file_content, ranges):
+    global pdf_executor
+    executor = pdf_executor
+    try:
+        return "".join(executor.map(extract_page_range, ranges))
+    except BrokenProcessPool:
+        # A worker died (e.g. MuPDF crashed on a malformed file or was OOM
+        # killed). Replace the pool so later uploads are unaffected, and
+        # extract this document in-process rather than crash a new worker.
+        app.logger.error("PDF worker pool broke, replacing it and extracting sequentially")
+        with pdf_executor_lock:
+            if pdf_executor is executor:
+                pdf_executor = create_pdf_executor()
+        executor.shutdown(wait=False)
+        with fitz.open(stream=file_content, filetype="pdf") as doc:
+            return "".join(page.get_text() for page in doc)
+
 def extract_text_from_pdf(file_content):
     try:
+        if fitz is not None:
+            with fitz.open(stream=file_content, filetype="pdf") as doc:
+                page_count = doc.page_count
+                if page_count < PDF_PARALLEL_MIN_PAGES:
+                    return "".join(page.get_text() for page in doc)
+            # One contiguous range per worker, so the document is only sent
+            # to and opened by each worker once
+            bounds = [page_count * i // PDF_WORKERS for i in range(PDF_WORKERS + 1)]
+            ranges = [
+                (file_content, start, stop)
+                for start, stop in zip(bounds, bounds[1:]) if start < stop
+            ]
+            return extract_ranges_in_pool(file_content, ranges)
         pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-        return "".join(page.extract_text() for page in pdf_reader.pages)
+        return "".join(page.extract_text() or "" for page in pdf_reader.pages)
     except Exception as e:
         app.logger.error(f"Error extracting text from PDF: {str(e)}")
         return None
 
-async def process_file(file_content, filename):
-    content_hash = hashlib.md5(file_content).hexdigest()
+def decode_text(file_content):
+    return file_content.decode('utf-8')
+
+# Text extractor per file extension; anything not listed is decoded as UTF-8
+TEXT_EXTRACTORS = {
+    'pdf': extract_text_from_pdf,
+    'txt': decode_text,
+}
+
+async def process_file(file_stream, filename, ext):
+    content_hash = await asyncio.to_thread(hash_stream, file_stream, UPLOAD_CHUNK_SIZE)
 
     # Check if this file has been processed before
-    existing_file = await asyncio.to_thread(files_collection.find_one, {'content_hash': content_hash})
+    existing_file = await files_collection.find_one(
+        {'content_hash': content_hash},
+        {'steps': 1, 'code': 1, '_id': 0}
+    )
     if existing_file:
         if existing_file.get('steps') and existing_file.get('code'):
             return {
@@ -107,10 +262,9 @@ async def process_file(file_content, filename):
             }
         elif existing_file.get('steps'):
             try:
-                code = await asyncio.to_thread(process_paper, existing_file['steps'], generate_steps=False)
-                await asyncio.to_thread(
-                    files_collection.update_one,
-                    {'_id': existing_file['_id']},
+                _, code = await process_paper(existing_file['steps'], generate_steps=False)
+                await files_collection.update_one(
+                    {'content_hash': content_hash},
                     {'$set': {'code': code}}
                 )
                 return {
@@ -121,61 +275,67 @@ async def process_file(file_content, filename):
             except Exception as e:
                 return {'error': f'Error generating code: {str(e)}'}, 500
 
-    # Process new file
-    if filename.lower().endswith('.pdf'):
-        paper_content = await asyncio.to_thread(extract_text_from_pdf, file_content)
-        if paper_content is None:
-            return {'error': 'Failed to extract text from PDF'}, 500
-    else:
-        paper_content = file_content.decode('utf-8')
+    # Process new file; only now is the whole body read into memory
+    file_stream.seek(0)
+    file_content = await asyncio.to_thread(file_stream.read)
+    extract_text = TEXT_EXTRACTORS.get(ext, decode_text)
+    paper_content = await asyncio.to_thread(extract_text, file_content)
+    if paper_content is None:
+        return {'error': f'Failed to extract text from {ext.upper()}'}, 500
 
-    steps, code = await asyncio.to_thread(process_paper, paper_content)
+    steps, code = await process_paper(paper_content, content_hash=content_hash)
 
     if steps is None:
         return {'error': 'Failed to generate steps from the paper'}, 500
 
-    # Store results in MongoDB
-    await asyncio.to_thread(
-        files_collection.insert_one,
-        {
+    # Prefilter rejections are heuristic, so they are never cached under the
+    # upload hash; a false negative must stay correctable on re-upload
+    if steps == NOT_RESEARCH_PAPER:
+        return {'steps': steps, 'code': code}
+
+    # Store results in MongoDB, keeping whichever request finished first
+    await files_collection.update_one(
+        {'content_hash': content_hash},
+        {'$setOnInsert': {
             'filename': filename,
-            'content_hash': content_hash,
             'steps': steps,
             'code': code
-        }
+        }},
+        upsert=True
     )
 
     return {'steps': steps, 'code': code}
 
+@app.errorhandler(RequestEntityTooLarge)
+async def file_too_large(e):
+    return jsonify({'error': f'File size exceeds the maximum limit of {app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)}MB'}), 413
+
 @app.route('/')
-def index():
-    return send_from_directory('static', 'index.html')
+async def index():
+    return await send_from_directory('static', 'index.html')
 
 @app.route('/logic.html')
-def logic():
-    return send_from_directory('static', 'logic.html')
+async def logic():
+    return await send_from_directory('static', 'logic.html')
 
 @app.route('/upload', methods=['POST'])
-@run_async
 @async_rate_limit
 async def upload_file():
-    if 'file' not in request.files:
+    files = await request.files
+    if 'file' not in files:
         return jsonify({'error': 'No file part in the request'}), 400
 
-    file = request.files['file']
+    file = files['file']
 
     if file.filename == '':
         return jsonify({'error': 'No file selected for upload'}), 400
 
-    if file and allowed_file(file.filename):
-        if file.content_length > app.config['MAX_CONTENT_LENGTH']:
-            return jsonify({'error': f'File size exceeds the maximum limit of {app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)}MB'}), 413
-
+    ext = allowed_file(file.filename)
+    if ext:
         filename = secure_filename(file.filename)
-        file_content = file.read()
 
         try:
-            result = await process_file(file_content, filename)
+            result = await process_file(file.stream, filename, ext)
             return jsonify(result)
         except UnicodeDecodeError:
             return jsonify({'error': 'The uploaded file is not a valid text file'}), 400
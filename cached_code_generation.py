@@ -1,15 +1,22 @@
 import os
 import time
+import asyncio
 import logging
-import hashlib
 import json
-from typing import Dict, Tuple, Optional
-from groq import Groq
+import re
+from typing import BinaryIO, Dict, Tuple, Optional
+import httpx
+from groq import AsyncGroq
 import google.generativeai as genai
 from dotenv import load_dotenv
 from google.api_core import exceptions
 import traceback
-from pymongo import MongoClient
+import functools
+import blake3
+import zstandard as zstd
+from bson.binary import Binary
+
+from db import get_database
 
 # Load environment variables
 load_dotenv()
@@ -20,21 +27,8 @@ logging.basicConfig(level=logging.DEBUG,
 logger = logging.getLogger(__name__)
 
 # MongoDB configuration
-MONGO_URI = os.getenv("MONGO_URI")
-if not MONGO_URI:
-    logger.critical("MONGO_URI environment variable is not set")
-    raise ValueError("MONGO_URI environment variable is not set")
-
-db_name = os.getenv("MONGO_DB_NAME") or "researchrender_db"
-
-try:
-    mongo_client = MongoClient(MONGO_URI)
-    db = mongo_client[db_name]
-    cache_collection = db.cache
-    logger.info("MongoDB initialized successfully")
-except Exception as e:
-    logger.critical(f"Failed to initialize MongoDB: {str(e)}")
-    raise
+db = get_database("researchrender_db")
+cache_collection = db.cache
 
 # Gemini API configuration
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -48,62 +42,174 @@ if not GROQ_API_KEY:
     logger.critical("GROQ_API_KEY environment variable is not set")
     raise ValueError("GROQ_API_KEY environment variable is not set")
 
-# Initialize API clients and MongoDB
+# Initialize API clients
 try:
     genai.configure(api_key=GEMINI_API_KEY)
-    groq_client = Groq(api_key=GROQ_API_KEY)
+    gemini_model = genai.GenerativeModel('models/gemini-1.5-flash-001')
+    # Keep one HTTP/2 connection to Groq warm so calls skip the TLS handshake
+    groq_client = AsyncGroq(
+        api_key=GROQ_API_KEY,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60.0)
+        )
+    )
     logger.info("API clients initialized successfully")
 except Exception as e:
     logger.critical(f"Failed to initialize API clients: {str(e)}")
     raise
 
+# The paper is sent as its own content part between these, so it is never
+# copied into a single formatted prompt string
+STEPS_PROMPT_PREFIX = """
+    You are the world's best researcher. You will be given a research paper and your task is to give a step-by-step list of instructions to implement the research paper.
+    """
+STEPS_PROMPT_SUFFIX = """
+
+    If it machine learning research paper then, Please generate a step-by-step list of instructions to implement the main ideas and algorithms described in this paper.
+    Provide the output in the following format:
+    - Steps: List of steps to implement the main ideas and algorithms described in this paper
+    If it is not machine learning research paper then,
+    - It is not research paper 
+    """
+
 # Rate limiting configuration
 GEMINI_RATE_LIMIT = 15  # requests per minute
 GROQ_RATE_LIMIT = 30  # requests per minute
-last_gemini_request = 0
-last_groq_request = 0
 
 
-def rate_limit(api_type: str) -> None:
-    """Apply rate limiting for API requests."""
-    global last_gemini_request, last_groq_request
-    current_time = time.time()
+class TokenBucket:
+    """Async token bucket allowing a fixed number of requests per minute.
 
-    if api_type == "gemini":
-        if current_time - last_gemini_request < 60 / GEMINI_RATE_LIMIT:
-            sleep_time = 60 / GEMINI_RATE_LIMIT - \
-                (current_time - last_gemini_request)
-            logger.debug(
-                f"Rate limiting Gemini API, sleeping for {sleep_time:.2f} seconds")
-            time.sleep(sleep_time)
-        last_gemini_request = time.time()
-    elif api_type == "groq":
-        if current_time - last_groq_request < 60 / GROQ_RATE_LIMIT:
-            sleep_time = 60 / GROQ_RATE_LIMIT - \
-                (current_time - last_groq_request)
-            logger.debug(
-                f"Rate limiting Groq API, sleeping for {sleep_time:.2f} seconds")
-            time.sleep(sleep_time)
-        last_groq_request = time.time()
-    else:
+    Capacity is a single token, so requests are spaced 60 / rate seconds apart
+    and never burst past the provider's per-minute quota.
+    """
+
+    def __init__(self, rate_per_min: int):
+        self.rate = rate_per_min
+        self.capacity = 1
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Take one token, sleeping until one is available. Returns the time waited."""
+        waited = 0.0
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate / 60)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) * 60 / self.rate
+                await asyncio.sleep(wait)
+                waited += wait
+
+
+rate_limiters: Dict[str, TokenBucket] = {
+    "gemini": TokenBucket(GEMINI_RATE_LIMIT),
+    "groq": TokenBucket(GROQ_RATE_LIMIT),
+}
+
+# Papers currently being processed, keyed by (content hash, generate_steps, generate_code)
+_inflight: Dict[Tuple[str, bool, bool], asyncio.Task] = {}
+
+
+async def rate_limit(api_type: str) -> None:
+    """Apply rate limiting for API requests without blocking the event loop."""
+    bucket = rate_limiters.get(api_type)
+    if bucket is None:
         logger.warning(f"Unknown API type for rate limiting: {api_type}")
+        return
 
+    waited = await bucket.acquire()
+    if waited:
+        logger.debug(
+            f"Rate limited {api_type} API, waited {waited:.2f} seconds")
 
+
+# Prefix marks the hash scheme so cache keys from older MD5 rows never collide
+CONTENT_HASH_PREFIX = "b3:"
+
+
+def hash_bytes(data: bytes) -> str:
+    """Generate a 128-bit BLAKE3 hash for raw bytes."""
+    return CONTENT_HASH_PREFIX + blake3.blake3(data).hexdigest(length=16)
+
+
+def hash_stream(stream: BinaryIO, chunk_size: int = 64 * 1024) -> str:
+    """Generate the same hash as hash_bytes, reading the stream in chunks."""
+    hasher = blake3.blake3()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        hasher.update(chunk)
+    return CONTENT_HASH_PREFIX + hasher.hexdigest(length=16)
+
+
+@functools.lru_cache(maxsize=256)
 def get_content_hash(content: str) -> str:
     """Generate a hash for the content."""
-    content_hash = hashlib.md5(content.encode()).hexdigest()
+    content_hash = hash_bytes(content.encode())
     logger.debug(f"Generated hash for content: {content_hash}")
     return content_hash
 
 
-def load_cache(content_hash: str, cache_type: str) -> Optional[str]:
+# Cheap checks run before any LLM call to reject inputs that are clearly not papers
+NOT_RESEARCH_PAPER = "It is not research paper"
+PAPER_MIN_CHARS = 1000
+PAPER_MIN_SECTIONS = 2
+PAPER_SCAN_CHARS = 200 * 1024  # Abstract and Introduction appear well within this
+# Section names only count as headings: at the start of a line, optionally
+# numbered ("2.", "3.1", "IV."), and ending the line or followed by punctuation
+PAPER_SECTION_PATTERN = re.compile(
+    r'^[ \t]*(?:(?:\d+(?:\.\d+)*|[IVX]+)\.?[ \t]+)?'
+    r'(abstract|introduction|related work|methodology|methods?|experiments?|'
+    r'results|conclusions?|references|bibliography)[ \t]*(?:$|[:.\u2014-])', re.I | re.M)
+
+
+def looks_like_paper(text: str) -> bool:
+    """Return whether the text is long enough and names enough typical paper sections."""
+    if len(text) < PAPER_MIN_CHARS:
+        return False
+    sections = set()
+    # Bounded so a huge non-paper can't stall the event loop on the regex
+    for match in PAPER_SECTION_PATTERN.finditer(text, 0, PAPER_SCAN_CHARS):
+        sections.add(match.group(1).lower())
+        if len(sections) >= PAPER_MIN_SECTIONS:
+            return True
+    return False
+
+
+# Cache entries at this version store their payload zstd-compressed under data_zstd
+CACHE_VERSION = 2
+zstd_compressor = zstd.ZstdCompressor(level=3)
+zstd_decompressor = zstd.ZstdDecompressor()
+
+
+async def ensure_cache_indexes() -> None:
+    """Create the index backing cache lookups; must run on the serving event loop."""
+    try:
+        await cache_collection.create_index(
+            [("content_hash", 1), ("type", 1)], unique=True)
+        logger.info("Cache indexes ensured")
+    except Exception as e:
+        logger.error(f"Failed to create cache indexes: {str(e)}")
+
+
+async def load_cache(content_hash: str, cache_type: str) -> Optional[str]:
     """Load cache from MongoDB."""
     try:
-        cache_item = cache_collection.find_one(
-            {"content_hash": content_hash, "type": cache_type})
+        cache_item = await cache_collection.find_one(
+            {"content_hash": content_hash, "type": cache_type},
+            {"data": 1, "data_zstd": 1, "version": 1, "_id": 0})
         if cache_item:
             logger.debug(
                 f"Cache loaded for hash {content_hash} and type {cache_type}")
+            if cache_item.get('version') == CACHE_VERSION:
+                return zstd_decompressor.decompress(cache_item['data_zstd']).decode()
             return cache_item['data']
         logger.debug(
             f"No existing cache found for hash {content_hash} and type {cache_type}")
@@ -113,12 +219,18 @@ def load_cache(content_hash: str, cache_type: str) -> Optional[str]:
         return None
 
 
-def save_cache(content_hash: str, cache_type: str, data: str) -> None:
+async def save_cache(content_hash: str, cache_type: str, data: str) -> None:
     """Save cache to MongoDB."""
     try:
-        cache_collection.update_one(
+        await cache_collection.update_one(
             {"content_hash": content_hash, "type": cache_type},
-            {"$set": {"data": data}},
+            {
+                "$set": {
+                    "data_zstd": Binary(zstd_compressor.compress(data.encode())),
+                    "version": CACHE_VERSION
+                },
+                "$unset": {"data": ""}
+            },
             upsert=True
         )
         logger.debug(
@@ -127,10 +239,11 @@ def save_cache(content_hash: str, cache_type: str, data: str) -> None:
         logger.error(f"Failed to save cache: {str(e)}")
 
 
-def convert_paper_to_steps(paper_text: str) -> Optional[str]:
+async def convert_paper_to_steps(paper_text: str, content_hash: Optional[str] = None) -> Optional[str]:
     """Convert paper text to steps, with caching and error handling."""
-    content_hash = get_content_hash(paper_text)
-    cached_steps = load_cache(content_hash, "steps")
+    if content_hash is None:
+        content_hash = get_content_hash(paper_text)
+    cached_steps = await load_cache(content_hash, "steps")
 
     if cached_steps:
         logger.info("Steps loaded from cache")
@@ -138,39 +251,28 @@ def convert_paper_to_steps(paper_text: str) -> Optional[str]:
 
     start_time = time.time()
 
-    prompt = f"""
-    You are the world's best researcher. You will be given a research paper and your task is to give a step-by-step list of instructions to implement the research paper.
-    {paper_text}
-
-    If it machine learning research paper then, Please generate a step-by-step list of instructions to implement the main ideas and algorithms described in this paper.
-    Provide the output in the following format:
-    - Steps: List of steps to implement the main ideas and algorithms described in this paper
-    If it is not machine learning research paper then,
-    - It is not research paper 
-    """
-
     max_retries = 3
     retry_delay = 5
 
     for attempt in range(max_retries):
         try:
-            rate_limit("gemini")
-            model = genai.GenerativeModel('models/gemini-1.5-flash-001')
-            result = model.generate_content(prompt)
+            await rate_limit("gemini")
+            result = await gemini_model.generate_content_async(
+                [STEPS_PROMPT_PREFIX, paper_text, STEPS_PROMPT_SUFFIX])
             steps = result.text
 
             operation_time = time.time() - start_time
             logger.info(
                 f"Paper processed successfully in {operation_time:.2f} seconds")
 
-            save_cache(content_hash, "steps", steps)
+            await save_cache(content_hash, "steps", steps)
 
             return steps
         except exceptions.InternalServerError as e:
             if attempt < max_retries - 1:
                 logger.warning(
                     f"Internal server error, retrying in {retry_delay} seconds: {str(e)}")
-                time.sleep(retry_delay)
+                await asyncio.sleep(retry_delay)
             else:
                 logger.error(
                     f"Failed to process paper after {max_retries} attempts: {str(e)}")
@@ -186,10 +288,10 @@ def convert_paper_to_steps(paper_text: str) -> Optional[str]:
     return None
 
 
-def steps_to_code(steps: str) -> Optional[str]:
+async def steps_to_code(steps: str) -> Optional[str]:
     """Convert steps to code, with caching and error handling."""
     content_hash = get_content_hash(steps)
-    cached_code = load_cache(content_hash, "code")
+    cached_code = await load_cache(content_hash, "code")
 
     if cached_code:
         logger.info("Code loaded from cache")
@@ -198,8 +300,8 @@ def steps_to_code(steps: str) -> Optional[str]:
     code_start_time = time.time()
 
     try:
-        rate_limit("groq")
-        code_creation = groq_client.chat.completions.create(
+        await rate_limit("groq")
+        code_creation = await groq_client.chat.completions.create(
             messages=[
                 {
                     "role": "user",
@@ -221,7 +323,7 @@ def steps_to_code(steps: str) -> Optional[str]:
         logger.info(
             f"Code generated successfully in {code_generation_time:.2f} seconds")
 
-        save_cache(content_hash, "code", generated_code)
+        await save_cache(content_hash, "code", generated_code)
 
         return generated_code
     except Exception as e:
@@ -230,7 +332,8 @@ def steps_to_code(steps: str) -> Optional[str]:
         return None
 
 
-def process_paper(content: str, generate_steps: bool = True, generate_code: bool = True) -> Tuple[Optional[str], Optional[str]]:
+async def process_paper(content: str, generate_steps: bool = True, generate_code: bool = True, *,
+                        content_hash: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
     """
     Process paper content and return generated steps and/or code.
 
@@ -238,17 +341,40 @@ def process_paper(content: str, generate_steps: bool = True, generate_code: bool
         content (str): The paper content or existing steps.
         generate_steps (bool): Whether to generate steps from the content. Default is True.
         generate_code (bool): Whether to generate code from the steps. Default is True.
+        content_hash (Optional[str]): Precomputed hash of the uploaded paper, used as the
+            steps cache key so the content is not hashed again. Default is None.
 
     Returns:
         Tuple[Optional[str], Optional[str]]: Generated steps and code, or None for each if generation fails.
     """
+    if generate_steps and not looks_like_paper(content):
+        logger.info("Content does not look like a research paper, skipping LLM calls")
+        return NOT_RESEARCH_PAPER, NOT_RESEARCH_PAPER if generate_code else None
+
+    key = (content_hash or get_content_hash(content), generate_steps, generate_code)
+    task = _inflight.get(key)
+    if task is not None:
+        logger.info("Identical content is already being processed, waiting for its result")
+    else:
+        # Run the work in its own task so a cancelled caller (e.g. a client
+        # disconnect) never aborts it for the other requests waiting on it
+        task = asyncio.create_task(
+            _process_paper(content, generate_steps, generate_code, content_hash))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def _process_paper(content: str, generate_steps: bool, generate_code: bool,
+                         content_hash: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """Run the LLM pipeline for process_paper without in-flight deduplication."""
     try:
         steps = None
         code = None
 
         if generate_steps:
             logger.info("Generating steps from paper content")
-            steps = convert_paper_to_steps(content)
+            steps = await convert_paper_to_steps(content, content_hash)
             if steps is None:
                 logger.warning("Failed to generate steps")
                 return None, None
@@ -257,7 +383,7 @@ def process_paper(content: str, generate_steps: bool = True, generate_code: bool
 
         if generate_code:
             logger.info("Generating code from steps")
-            code = steps_to_code(steps)
+            code = await steps_to_code(steps)
             if code is None:
                 logger.warning("Failed to generate code")
                 return steps, None
@@ -274,7 +400,7 @@ def process_paper(content: str, generate_steps: bool = True, generate_code: bool
 #     # Example usage and testing
 #     test_paper_content = "This is a test paper content."
 #     logger.info("Testing with sample paper content")
-#     steps, code = process_paper(test_paper_content)
+#     steps, code = asyncio.run(process_paper(test_paper_content))
 #     if steps and code:
 #         logger.info("Test successful: Steps and code generated")
 #     else:
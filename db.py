@@ -0,0 +1,38 @@
+import os
+import logging
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# MongoDB configuration
+MONGO_URI = os.getenv("MONGO_URI")
+if not MONGO_URI:
+    logger.critical("MONGO_URI environment variable is not set")
+    raise ValueError("MONGO_URI environment variable is not set")
+
+# Connection pool sized for short requests; a single client is shared by
+# every module in the process so each worker only opens one pool
+try:
+    mongo_client = AsyncIOMotorClient(
+        MONGO_URI,
+        maxPoolSize=32,
+        minPoolSize=4,
+        waitQueueTimeoutMS=1000,
+        socketTimeoutMS=5000,
+        retryWrites=True,
+        compressors='zstd,zlib'
+    )
+    logger.info("MongoDB client initialized successfully")
+except Exception as e:
+    logger.critical(f"Failed to initialize MongoDB client: {str(e)}")
+    raise
+
+
+def get_database(default_name: str):
+    """Return the database named by MONGO_DB_NAME, or default_name if it is unset."""
+    return mongo_client[os.getenv("MONGO_DB_NAME") or default_name]
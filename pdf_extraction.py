@@ -0,0 +1,10 @@
+import fitz  # PyMuPDF
+
+
+# Kept out of app.py so that, when served by hypercorn, process pool workers
+# only import this module. Under `python app.py` multiprocessing still
+# re-imports __main__ in each worker, which loads the whole app there too.
+def extract_page_range(args):
+    file_content, start, stop = args
+    with fitz.open(stream=file_content, filetype="pdf") as doc:
+        return "".join(doc[i].get_text() for i in range(start, stop))